@@ -2,22 +2,54 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
+from collections import deque
 from datetime import datetime, timedelta
-import time
+import io
 import random
 
 # Set page config
 st.set_page_config(page_title="Syringe Inspection Simulator", layout="wide")
 
+# Tag names are a small fixed set, so store them as categorical codes
+TAG_DTYPE = pd.CategoricalDtype(['tag-1', 'tag-2', 'tag-3', 'tag-4', 'tag-5'])
+
+# Tags written on every tick, in the order generate_interval_data returns their values
+STREAM_TAGS = ['tag-1', 'tag-2', 'tag-3', 'tag-4', 'tag-5']
+STREAM_TAG_CODES = np.array([TAG_DTYPE.categories.get_loc(tag) for tag in STREAM_TAGS], dtype='int8')
+
+# Number of ticks kept in memory; older ticks are overwritten, so plots and saved files
+# only cover the last MAX_TICKS intervals (the running totals still cover the whole session)
+MAX_TICKS = 2000
+BUFFER_CAPACITY = MAX_TICKS * len(STREAM_TAGS)
+
+# Maximum number of points sent to the browser per trace
+MAX_PLOT_POINTS = 1000
+
 # Initialize session state variables
 if 'streaming' not in st.session_state:
     st.session_state.streaming = False
+if 'buffer' not in st.session_state:
+    # Ring buffer with one preallocated array per column
+    st.session_state.buffer = {
+        'TAGNAME': np.empty(BUFFER_CAPACITY, dtype='int8'),
+        'TAGVALUE': np.empty(BUFFER_CAPACITY, dtype='int32'),
+        'TIMESTAMP': np.empty(BUFFER_CAPACITY, dtype='datetime64[ns]'),
+        'BATCH': np.empty(BUFFER_CAPACITY, dtype='int16')
+    }
+    st.session_state.rows_written = 0
 if 'data' not in st.session_state:
-    st.session_state.data = pd.DataFrame(columns=['TAGNAME', 'TAGVALUE', 'TIMESTAMP'])
-if 'start_time' not in st.session_state:
-    st.session_state.start_time = datetime.now()
-if 'cumulative_data' not in st.session_state:
-    st.session_state.cumulative_data = pd.DataFrame(columns=['TAGNAME', 'TAGVALUE', 'TIMESTAMP'])
+    st.session_state.data = pd.DataFrame(columns=['TAGNAME', 'TAGVALUE', 'TIMESTAMP', 'BATCH']).astype({'TAGNAME': TAG_DTYPE})
+    st.session_state.data_rows = 0
+if 'last_tick' not in st.session_state:
+    st.session_state.last_tick = None
+if 'batch_name' not in st.session_state:
+    # Rows store the index of their batch in batch_names
+    st.session_state.batch_name = None
+    st.session_state.batch_names = []
+if 'cum_rows' not in st.session_state:
+    st.session_state.cum_tag4 = 0
+    st.session_state.cum_tag5 = 0
+    st.session_state.cum_rows = deque(maxlen=MAX_TICKS)
 
 # Sidebar controls
 st.sidebar.title("Control Panel")
@@ -35,188 +67,245 @@ defect_rate_3 = st.sidebar.slider("Tag-3 (Wall Defect)", 0.0, 5.0, 0.8)
 # Inspection rate
 inspections_per_interval = st.sidebar.slider("Inspections per 5-min interval", 100, 1000, 500)
 
-def generate_interval_data(timestamp):
-    """Generate data for one 5-minute interval"""
-    data = []
-    
-    # Calculate defects based on rates
-    defects_1 = int(inspections_per_interval * (defect_rate_1 / 100))
-    defects_2 = int(inspections_per_interval * (defect_rate_2 / 100))
-    defects_3 = int(inspections_per_interval * (defect_rate_3 / 100))
+# Expected defects per interval only change with the sliders, so compute them once per
+# script run rather than on every fragment tick
+expected_defects = inspections_per_interval * np.array([defect_rate_1, defect_rate_2, defect_rate_3]) / 100
+
+def generate_interval_data():
+    """Generate the tag-1 to tag-5 values for one 5-minute interval"""
+    # Draw defect counts around the expected rates (Poisson counts are never negative)
+    defects_1, defects_2, defects_3 = np.random.poisson(expected_defects).tolist()
     total_defects = defects_1 + defects_2 + defects_3
     
-    # Add noise to make it more realistic
-    defects_1 += np.random.randint(-2, 3)
-    defects_2 += np.random.randint(-2, 3)
-    defects_3 += np.random.randint(-2, 3)
+    return np.array([defects_1, defects_2, defects_3, total_defects, inspections_per_interval], dtype='int32')
+
+def append_interval(timestamp, values):
+    """Write one interval's rows into the ring buffer"""
+    buffer = st.session_state.buffer
+    # The capacity is a multiple of the rows per tick, so a tick never straddles the wrap
+    start = st.session_state.rows_written % BUFFER_CAPACITY
+    end = start + len(STREAM_TAGS)
+    buffer['TAGNAME'][start:end] = STREAM_TAG_CODES
+    buffer['TAGVALUE'][start:end] = values
+    buffer['TIMESTAMP'][start:end] = np.datetime64(timestamp, 'ns')
+    buffer['BATCH'][start:end] = st.session_state.batch_names.index(st.session_state.batch_name)
+    st.session_state.rows_written += len(STREAM_TAGS)
+
+def as_dataframe():
+    """Wrap the filled part of the ring buffer, oldest row first, rebuilding only when new rows arrived"""
+    rows_written = st.session_state.rows_written
+    if st.session_state.data_rows != rows_written:
+        buffer = st.session_state.buffer
+        if rows_written <= BUFFER_CAPACITY:
+            columns = {name: column[:rows_written] for name, column in buffer.items()}
+        else:
+            start = rows_written % BUFFER_CAPACITY
+            columns = {name: np.concatenate([column[start:], column[:start]]) for name, column in buffer.items()}
+        # Wrap the arrays without copying. Before the buffer wraps, the frame is a view that later
+        # writes can overwrite, so it is only valid through as_dataframe(), which rebuilds it
+        # whenever rows were written; never read st.session_state.data directly
+        st.session_state.data = pd.DataFrame({
+            'TAGNAME': pd.Categorical.from_codes(columns['TAGNAME'], dtype=TAG_DTYPE),
+            'TAGVALUE': columns['TAGVALUE'],
+            'TIMESTAMP': columns['TIMESTAMP'],
+            'BATCH': pd.Categorical.from_codes(columns['BATCH'], categories=list(st.session_state.batch_names))
+        }, copy=False)
+        st.session_state.data_rows = rows_written
+    return st.session_state.data
+
+def downsample(x, y, n_out=MAX_PLOT_POINTS):
+    """Reduce a trace to n_out points with Largest-Triangle-Three-Buckets (LTTB)"""
+    n = len(x)
+    if n <= n_out:
+        return x, y
     
-    # Ensure non-negative values
-    defects_1 = max(0, defects_1)
-    defects_2 = max(0, defects_2)
-    defects_3 = max(0, defects_3)
-    total_defects = defects_1 + defects_2 + defects_3
+    xs = x.astype('int64').astype('float64')
+    ys = y.astype('float64')
     
-    # Create rows for each tag
-    data.append({'TAGNAME': 'tag-1', 'TAGVALUE': defects_1, 'TIMESTAMP': timestamp})
-    data.append({'TAGNAME': 'tag-2', 'TAGVALUE': defects_2, 'TIMESTAMP': timestamp})
-    data.append({'TAGNAME': 'tag-3', 'TAGVALUE': defects_3, 'TIMESTAMP': timestamp})
-    data.append({'TAGNAME': 'tag-4', 'TAGVALUE': total_defects, 'TIMESTAMP': timestamp})
-    data.append({'TAGNAME': 'tag-5', 'TAGVALUE': inspections_per_interval, 'TIMESTAMP': timestamp})
+    # First and last points are always kept, the rest are split into n_out - 2 buckets
+    edges = np.append(np.linspace(1, n - 1, n_out - 1).astype('int64'), n)
+    indices = np.empty(n_out, dtype='int64')
+    indices[0] = 0
+    indices[-1] = n - 1
     
-    return pd.DataFrame(data)
-
-def update_cumulative_data():
-    """Update cumulative values for tag-4 and tag-5"""
-    cumulative_data = []
+    # Bucket means do not depend on the picked points, so compute them all in one pass
+    counts = np.diff(edges)
+    mean_x = np.add.reduceat(xs, edges[:-1]) / counts
+    mean_y = np.add.reduceat(ys, edges[:-1]) / counts
     
-    for tag in ['tag-4', 'tag-5']:
-        tag_data = st.session_state.data[st.session_state.data['TAGNAME'] == tag].copy()
-        if not tag_data.empty:
-            tag_data['TAGVALUE'] = tag_data['TAGVALUE'].cumsum()
-            cumulative_data.append(tag_data)
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Keep the point forming the largest triangle with the previous pick and the next bucket's mean
+        area = np.abs((xs[a] - mean_x[i + 1]) * (ys[start:end] - ys[a]) - (xs[a] - xs[start:end]) * (mean_y[i + 1] - ys[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
     
-    if cumulative_data:
-        st.session_state.cumulative_data = pd.concat(cumulative_data, ignore_index=True)
+    return x[indices], y[indices]
+
+def make_figure(title, yaxis_title):
+    """Create an empty figure with the shared plot layout"""
+    fig = go.Figure()
+    fig.update_layout(
+        title=title,
+        xaxis_title="Time",
+        yaxis_title=yaxis_title,
+        height=300,
+        uirevision='stream'
+    )
+    return fig
 
 def create_plots():
-    """Create and update all three plots"""
+    """Create all three plots with one (initially empty) trace per series"""
     # 1. Individual defects plot (tag-1, tag-2, tag-3)
-    fig1 = go.Figure()
+    fig1 = make_figure("Individual Defect Types Over Time", "Number of Defects")
     
     for tag in ['tag-1', 'tag-2', 'tag-3']:
-        tag_data = st.session_state.data[st.session_state.data['TAGNAME'] == tag].copy()
-        if not tag_data.empty:
-            fig1.add_trace(go.Scatter(
-                x=tag_data['TIMESTAMP'],
-                y=tag_data['TAGVALUE'],
-                name=tag,
-                mode='lines+markers'
-            ))
-    
-    fig1.update_layout(
-        title="Individual Defect Types Over Time",
-        xaxis_title="Time",
-        yaxis_title="Number of Defects",
-        height=300
-    )
+        fig1.add_trace(go.Scattergl(
+            name=tag,
+            mode='lines+markers'
+        ))
     
     # 2. Total defects plot (tag-4)
-    fig2 = go.Figure()
-    
-    tag4_data = st.session_state.cumulative_data[st.session_state.cumulative_data['TAGNAME'] == 'tag-4'].copy()
-    if not tag4_data.empty:
-        fig2.add_trace(go.Scatter(
-            x=tag4_data['TIMESTAMP'],
-            y=tag4_data['TAGVALUE'],
-            name='Total Cumulative Defects',
-            mode='lines+markers',
-            line=dict(width=3, color='red')
-        ))
+    fig2 = make_figure("Cumulative Total Defects Over Time", "Total Number of Defects")
     
-    fig2.update_layout(
-        title="Cumulative Total Defects Over Time",
-        xaxis_title="Time",
-        yaxis_title="Total Number of Defects",
-        height=300
-    )
+    fig2.add_trace(go.Scattergl(
+        name='Total Cumulative Defects',
+        mode='lines+markers',
+        line=dict(width=3, color='red')
+    ))
     
     # 3. Total inspected plot (tag-5)
-    fig3 = go.Figure()
-    
-    tag5_data = st.session_state.cumulative_data[st.session_state.cumulative_data['TAGNAME'] == 'tag-5'].copy()
-    if not tag5_data.empty:
-        fig3.add_trace(go.Scatter(
-            x=tag5_data['TIMESTAMP'],
-            y=tag5_data['TAGVALUE'],
-            name='Total Inspected',
-            mode='lines+markers',
-            line=dict(width=3, color='green')
-        ))
+    fig3 = make_figure("Cumulative Total Inspected Syringes Over Time", "Number of Inspected Syringes")
     
-    fig3.update_layout(
-        title="Cumulative Total Inspected Syringes Over Time",
-        xaxis_title="Time",
-        yaxis_title="Number of Inspected Syringes",
-        height=300
-    )
+    fig3.add_trace(go.Scattergl(
+        name='Total Inspected',
+        mode='lines+markers',
+        line=dict(width=3, color='green')
+    ))
+    
+    return fig1, fig2, fig3
+
+def update_plots():
+    """Update the trace data of the session's plots in place"""
+    if 'figs' not in st.session_state:
+        st.session_state.figs = create_plots()
+    fig1, fig2, fig3 = st.session_state.figs
+    
+    # The buffer only grows, so an unchanged row count means the traces are already current
+    if st.session_state.get('plot_rows') == st.session_state.rows_written:
+        return fig1, fig2, fig3
+    st.session_state.plot_rows = st.session_state.rows_written
+    
+    data = as_dataframe()
+    groups = data.groupby('TAGNAME', sort=False, observed=True).indices
+    timestamps = data['TIMESTAMP'].values
+    tag_values = data['TAGVALUE'].values
+    cumulative_data = pd.DataFrame(st.session_state.cum_rows, columns=['TIMESTAMP', 'tag-4', 'tag-5'])
+    
+    with fig1.batch_update():
+        for trace in fig1.data:
+            positions = groups.get(trace.name)
+            if positions is not None:
+                trace.x, trace.y = downsample(timestamps[positions], tag_values[positions])
+    
+    with fig2.batch_update():
+        fig2.data[0].x, fig2.data[0].y = downsample(cumulative_data['TIMESTAMP'].values, cumulative_data['tag-4'].values)
+    
+    with fig3.batch_update():
+        fig3.data[0].x, fig3.data[0].y = downsample(cumulative_data['TIMESTAMP'].values, cumulative_data['tag-5'].values)
     
     return fig1, fig2, fig3
 
+def display_dashboard():
+    """Draw the plots and the current metrics"""
+    fig1, fig2, fig3 = update_plots()
+    st.plotly_chart(fig1, use_container_width=True)
+    st.plotly_chart(fig2, use_container_width=True)
+    st.plotly_chart(fig3, use_container_width=True)
+    
+    cols = st.columns(4)
+    
+    if st.session_state.cum_tag5:
+        cols[0].metric("Total Inspected", st.session_state.cum_tag5)
+        cols[1].metric("Total Defects", st.session_state.cum_tag4)
+        defect_rate = (st.session_state.cum_tag4 / st.session_state.cum_tag5) * 100
+        cols[2].metric("Defect Rate", f"{defect_rate:.2f}%")
+        cols[3].metric("Batch", st.session_state.batch_name)
+
+def record_interval(current_time):
+    """Generate one interval of data and update the running totals"""
+    values = generate_interval_data()
+    append_interval(current_time, values)
+    
+    # Update running totals for tag-4 and tag-5
+    st.session_state.cum_tag4 += int(values[STREAM_TAGS.index('tag-4')])
+    st.session_state.cum_tag5 += int(values[STREAM_TAGS.index('tag-5')])
+    st.session_state.cum_rows.append({
+        'TIMESTAMP': np.datetime64(current_time, 'ns'),
+        'tag-4': st.session_state.cum_tag4,
+        'tag-5': st.session_state.cum_tag5
+    })
+    st.session_state.last_tick = current_time
+
+# Only this fragment reruns on each tick; the sidebar and page setup are left alone
+@st.fragment(run_every=stream_speed)
+def stream_tick():
+    """Generate the intervals that came due since the last tick and redraw the dashboard once"""
+    current_time = datetime.now()
+    last_tick = st.session_state.last_tick
+    if last_tick is None:
+        record_interval(current_time)
+    else:
+        # Widget changes rerun the whole script, and with it this fragment, so rounding
+        # gives half an interval of slack before an extra interval is added. When reruns
+        # fall behind, every interval that came due is recorded before a single redraw.
+        due = round((current_time - last_tick).total_seconds() / stream_speed)
+        if due > MAX_TICKS:
+            # After a long gap (throttled tab, sleeping laptop) only the intervals that fit
+            # in the buffer are backfilled, ending at the current time
+            due = MAX_TICKS
+            last_tick = current_time - timedelta(seconds=due * stream_speed)
+        for i in range(1, due + 1):
+            # Rounding up can make the last interval due slightly early; never stamp it in the future
+            record_interval(min(last_tick + timedelta(seconds=i * stream_speed), current_time))
+    
+    display_dashboard()
+
 # Create main layout
 st.title("Syringe Inspection Data Stream Simulator")
 
-# Create placeholders for plots
-defect_plot = st.empty()
-total_defects_plot = st.empty()
-inspection_plot = st.empty()
-metrics_placeholder = st.container()
-
 # Start/Stop button
 if st.sidebar.button("Start/Stop Stream"):
     st.session_state.streaming = not st.session_state.streaming
     if st.session_state.streaming:
-        st.session_state.start_time = datetime.now()
-        # Add batch start marker
-        batch_start = pd.DataFrame([{
-            'TAGNAME': 'tag-0',
-            'TAGVALUE': batch_name,
-            'TIMESTAMP': st.session_state.start_time
-        }])
-        st.session_state.data = pd.concat([st.session_state.data, batch_start], ignore_index=True)
+        st.session_state.batch_name = batch_name
+        if batch_name not in st.session_state.batch_names:
+            st.session_state.batch_names.append(batch_name)
+        st.session_state.last_tick = None
 
 # Save data button
+save_format = st.sidebar.selectbox("Save Format", ["Parquet", "Excel"])
 if st.sidebar.button("Save Data"):
-    if not st.session_state.data.empty:
-        st.session_state.data.to_excel("inspection_data.xlsx", index=False)
-        st.sidebar.success("Data saved to inspection_data.xlsx")
+    if st.session_state.rows_written:
+        data = as_dataframe()
+        if save_format == "Parquet":
+            file_data = data.to_parquet(index=False, compression='zstd')
+            file_name = "inspection_data.parquet"
+        else:
+            buffer = io.BytesIO()
+            data.to_excel(buffer, index=False)
+            file_data = buffer.getvalue()
+            file_name = "inspection_data.xlsx"
+        st.sidebar.download_button(f"Download {file_name}", file_data, file_name=file_name)
+        if st.session_state.rows_written > BUFFER_CAPACITY:
+            st.sidebar.caption(
+                f"Only the last {MAX_TICKS} intervals are kept: the file covers "
+                f"{data['TIMESTAMP'].iloc[0]:%Y-%m-%d %H:%M:%S} to {data['TIMESTAMP'].iloc[-1]:%Y-%m-%d %H:%M:%S}"
+            )
 
-# Main streaming loop
-while st.session_state.streaming:
-    # Generate new data
-    current_time = datetime.now()
-    new_data = generate_interval_data(current_time)
-    st.session_state.data = pd.concat([st.session_state.data, new_data], ignore_index=True)
-    
-    # Update cumulative data
-    update_cumulative_data()
-    
-    # Create and update plots
-    fig1, fig2, fig3 = create_plots()
-    defect_plot.plotly_chart(fig1, use_container_width=True)
-    total_defects_plot.plotly_chart(fig2, use_container_width=True)
-    inspection_plot.plotly_chart(fig3, use_container_width=True)
-    
-    # Display current metrics
-    with metrics_placeholder:
-        cols = st.columns(4)
-        latest_data = st.session_state.data.groupby('TAGNAME').last()
-        cumulative_data = st.session_state.cumulative_data.groupby('TAGNAME').last()
-        
-        if not latest_data.empty and not cumulative_data.empty:
-            cols[0].metric("Total Inspected", int(cumulative_data.loc['tag-5', 'TAGVALUE']))
-            cols[1].metric("Total Defects", int(cumulative_data.loc['tag-4', 'TAGVALUE']))
-            defect_rate = (cumulative_data.loc['tag-4', 'TAGVALUE'] / cumulative_data.loc['tag-5', 'TAGVALUE']) * 100
-            cols[2].metric("Defect Rate", f"{defect_rate:.2f}%")
-            cols[3].metric("Batch", batch_name)
-    
-    time.sleep(stream_speed)
-
-# Keep displaying the plots even when streaming is stopped
-if not st.session_state.streaming and not st.session_state.data.empty:
-    fig1, fig2, fig3 = create_plots()
-    defect_plot.plotly_chart(fig1, use_container_width=True)
-    total_defects_plot.plotly_chart(fig2, use_container_width=True)
-    inspection_plot.plotly_chart(fig3, use_container_width=True)
-    
-    # Display final metrics
-    with metrics_placeholder:
-        cols = st.columns(4)
-        latest_data = st.session_state.data.groupby('TAGNAME').last()
-        cumulative_data = st.session_state.cumulative_data.groupby('TAGNAME').last()
-        
-        if not latest_data.empty and not cumulative_data.empty:
-            cols[0].metric("Total Inspected", int(cumulative_data.loc['tag-5', 'TAGVALUE']))
-            cols[1].metric("Total Defects", int(cumulative_data.loc['tag-4', 'TAGVALUE']))
-            defect_rate = (cumulative_data.loc['tag-4', 'TAGVALUE'] / cumulative_data.loc['tag-5', 'TAGVALUE']) * 100
-            cols[2].metric("Defect Rate", f"{defect_rate:.2f}%")
-            cols[3].metric("Batch", batch_name)
\ No newline at end of file
+# Stream one tick per fragment run, or keep displaying the plots when stopped
+if st.session_state.streaming:
+    stream_tick()
+elif st.session_state.rows_written:
+    display_dashboard()
\ No newline at end of file